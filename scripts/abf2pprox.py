@@ -14,15 +14,16 @@ user has to point it to the ABF channel that contains the command protocol using
 
 """
 import datetime
-import json
 import logging
-from collections import defaultdict
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
 from pathlib import Path
 
 import nbank as nb
 import numpy as np
-import quantities as pq
-import quickspikes.tools as qst
+import orjson
 import requests as rq
 from neo import AxonIO
 from quickspikes.intracellular import SpikeFinder, spike_shape
@@ -30,26 +31,43 @@ from quickspikes.intracellular import SpikeFinder, spike_shape
 from core import (
     Interval,
     _units,
-    first_index,
+    interval_means,
     json_serializable,
     junction_potential,
     setup_log,
-    with_units,
 )
 
 birddb_url = "https://gracula.psyc.virginia.edu/birds/api/animals/"
 log = logging.getLogger()
-__version__ = "20221026"
+__version__ = "20230726"
 
-# some hard-coded intervals
-interval_padding = 2 * pq.ms
-steady_interval_depol = 300 * pq.ms
-steady_interval_hypol = 150 * pq.ms
+# some hard-coded intervals (ms)
+interval_padding = 2.0
+steady_interval_depol = 300.0
+steady_interval_hypol = 150.0
+# junction potential as a scalar (mV) for trace arithmetic
+junction_mV = float(junction_potential.rescale(_units["voltage"]).magnitude)
+
+
+def load_signal(sig, unit) -> np.ndarray:
+    """Load an analog signal as a plain array in the units of `unit`.
+
+    The rescaling is done with a single scalar multiply on the raw magnitude,
+    which avoids allocating the intermediate Quantity arrays that
+    `.load().rescale(unit)` creates. Raises ValueError if the signal's units
+    are not compatible with `unit`.
+
+    """
+    scale = float(sig.units.rescale(unit).magnitude)
+    if hasattr(sig, "load"):
+        sig = sig.load()
+    return sig.magnitude.squeeze() * scale
 
 
 def series_resistance(current, voltage, idx, i_before, i_after):
     """Calculates ΔV/ΔI around idx. The differences are calculated using the
-    current and voltage at idx and the values at idx + i_after.
+    current and voltage at idx and the values at idx + i_after. Returns the
+    resistance in MΩ, given voltage in mV and current in pA.
 
     """
     # before = Interval(idx - i_before, idx, None)
@@ -57,23 +75,26 @@ def series_resistance(current, voltage, idx, i_before, i_after):
     # dV = before.mean_of(voltage) - voltage[idx + i_after]
     dI = current[idx] - current[idx + i_after]
     dV = voltage[idx] - voltage[idx + i_after]
-    return (dV * _units["voltage"]) / (dI * _units["current"])
+    # mV/pA -> MΩ
+    return (dV / dI) * 1e3
 
 
 def time_constant(
-    current: list[np.ndarray],
-    voltage: list[np.ndarray],
+    current: np.ndarray,
+    voltage: np.ndarray,
     dt: float,
     decay_thresh: float = 0.99,
     max_err: float = 0.05,
 ):
     """Calculate tau and Cm from the average of hyperpolarization steps
 
-    current: list of current steps
-    voltage: list of voltage responses
-    dt: sampling period (used to convert time constants to appropriate units)
+    current: 2-D array of current steps (sweeps x samples, pA)
+    voltage: 2-D array of voltage responses (sweeps x samples, mV)
+    dt: sampling period (ms)
     decay_thresh: fit the decay up to this fraction of the trough
 
+    Returns tau in ms and Cm in pF.
+
     """
     from chebyfit import fit_exponentials
 
@@ -82,33 +103,395 @@ def time_constant(
     if len(current) == 0 or len(voltage) == 0:
         log.debug("   - no data (contaminated by spikes?)")
         return stats
-    hI = np.mean(current, axis=0)
-    hV = np.mean(voltage, axis=0)
+    hI = current.mean(axis=0)
+    hV = voltage.mean(axis=0)
     i_min = hV.argmin()
     thresh = hV[0] - (hV[0] - hV[i_min]) * decay_thresh
-    i_thresh = first_index(lambda x: x < thresh, hV[:i_min])
+    below = hV[:i_min] < thresh
+    i_thresh = int(np.argmax(below)) if below.any() else None
     params, est = fit_exponentials(hV[:i_thresh], 1, deltat=dt, axis=0)
     if params[0]["amplitude"] <= 0 or params[0]["rate"] <= 0:
         log.debug("   - unable to fit double exponential")
         return stats
-    tau = params[0]["rate"] * _units["time"]
-    dV = params[0]["amplitude"] * _units["voltage"]
-    dI = (hI[0] - hI[i_min]) * _units["current"]
-    # use the faster component with positive amplitude
-    Rm = (dV / dI).rescale(_units["resistance"])
+    tau = params[0]["rate"]
+    dV = params[0]["amplitude"]
+    dI = hI[0] - hI[i_min]
+    # use the faster component with positive amplitude; mV/pA -> MΩ
+    Rm = (dV / dI) * 1e3
     # error is calculated for first tau/2 or 25 ms, whichever is less
-    idx = int(min(25, tau / 2) / sampling_period)
+    idx = int(min(25.0, tau / 2) / dt)
     err = np.sqrt(((hV[:idx] - est[:idx]) ** 2).mean()) / dV
     if err > max_err:
         log.debug("- fit error exceeds %.1f of voltage difference, excluding")
         return stats
     return {
         "tau": tau,
-        "Cm": (tau / Rm).rescale(_units["capacitance"]),
+        # ms/MΩ -> nF -> pF
+        "Cm": tau / Rm * 1e3,
         "mse": err,
     }
 
 
+def channel_scales(signals):
+    """Determine unit conversion factors for the channels of a sweep.
+
+    *signals* is the list of (lazy) analog signals from one segment. Returns
+    scalar factors that convert the voltage and current channels to the
+    canonical units, and the temperature channel if present (None otherwise).
+    Raises ValueError if the first two channels are not voltage and current.
+
+    """
+    try:
+        v_scale = float(signals[0].units.rescale(_units["voltage"]).magnitude)
+    except ValueError:
+        raise ValueError(
+            "not a current clamp recording (signal 0 units not voltage)"
+        ) from None
+    try:
+        i_scale = float(signals[1].units.rescale(_units["current"]).magnitude)
+    except ValueError:
+        raise ValueError(
+            "not a current clamp recording (signal 1 units not current)"
+        ) from None
+    t_scale = None
+    if len(signals) > 2:
+        try:
+            t_scale = float(signals[2].units.rescale(_units["temperature"]).magnitude)
+        except ValueError:
+            pass
+    return {"voltage": v_scale, "current": i_scale, "temperature": t_scale}
+
+
+def process_sweep(sigs, sweep_idx, t_start, protocol, scales, rate_hz, detector_params, args):
+    """Analyze one sweep: detect spikes and compute statistics for each step.
+
+    The sweeps in an epoch are independent of each other, so this can be run
+    concurrently for all of the segments in a block. The sweep's data comes in
+    as *sigs*, a (samples x channels) float view into the block-wide buffer
+    read by the caller in a single sequential pass, so no per-sweep file
+    access is needed here.
+    Returns `(trial, hypol)`, where trial is the pprox trial dict and hypol
+    is an (I, V) pair of arrays covering the first hyperpolarization step, or
+    None if that step was contaminated by spikes. Raises ValueError if the
+    sweep does not look like a current-clamp step recording.
+
+    """
+    log.debug("- sweep %d:", sweep_idx)
+    # scalar sampling factors; all times in the trial dict are plain floats
+    # (seconds for events/intervals, ms for spike shape), with the units
+    # recorded once in the pprox header
+    rate_khz = rate_hz / 1e3
+    sp_ms = 1e3 / rate_hz
+    sp_s = 1.0 / rate_hz
+    V = sigs[:, 0] * scales["voltage"] - junction_mV
+    I = sigs[:, 1] * scales["current"]
+    if scales["temperature"] is not None:
+        T = sigs[:, 2].mean() * scales["temperature"]
+    else:
+        T = None
+    try:
+        Ic = load_signal(
+            protocol.analogsignals[args.command_channel],
+            _units["current"],
+        )
+    except IndexError:
+        raise ValueError("no protocol information - gapfree?") from None
+    except ValueError:
+        raise ValueError(
+            f"protocol channel {args.command_channel} is not in units of current"
+        ) from None
+    if Ic.size == 0:
+        raise ValueError(
+            f"protocol channel {args.command_channel} does not have any current steps"
+        )
+    # the command channel is piecewise constant, so the steps can be found
+    # with a single vectorized diff; values are truncated to make finding
+    # zeros easier
+    idx = np.flatnonzero(np.diff(Ic)) + 1
+    step_start = np.r_[0, idx]
+    step_end = np.r_[idx, Ic.size]
+    step_val = Ic[step_start].astype("i")
+
+    trial = {
+        "index": sweep_idx,
+        "offset": t_start,
+        "events": [],
+        "interval": [0.0, sigs.shape[0] * sp_s],
+        "temperature": T,
+    }
+    if args.compute_stats:
+        trial["marks"] = {}
+
+    # detect spikes
+    # we set the threshold based on the amplitude of the first spike. the
+    # detector carries per-sweep threshold state, so each sweep gets its own
+    detector = SpikeFinder(*detector_params)
+    first_spike = detector.calculate_threshold(
+        V, args.spike_thresh_rel, args.spike_thresh_min
+    )
+    if first_spike is None:
+        log.debug("  ✗ no spikes")
+    elif (
+        first_spike.peak_V - first_spike.takeoff_V
+        < args.first_spike_amplitude_min
+    ):
+        log.debug("  ✗ first spike amplitude is too low")
+    else:
+        trial["first_spike"] = dict(
+            base=first_spike.takeoff_V,
+            thresh=detector.spike_thresh,
+            width=(first_spike.half_rise_t + first_spike.half_decay_t) * sp_ms,
+            trough_t=first_spike.trough_t * sp_ms,
+        )
+        detected = list(
+            detector.extract_spikes(V, args.spike_amplitude_min, args.spike_upsample)
+        )
+        trial["events"] = [time * sp_s for time, _ in detected]
+        if args.compute_stats and detected:
+            # the spike count is known, so the marks go into preallocated
+            # float buffers (serialized natively by orjson) instead of lists
+            # of boxed scalars
+            marks = {}
+            for i, (_, spike) in enumerate(detected):
+                shape = spike_shape(spike, sp_ms)
+                if not marks:
+                    marks = {k: np.empty(len(detected)) for k in shape._fields}
+                for k, v in zip(shape._fields, shape):
+                    marks[k][i] = v.item() if hasattr(v, "item") else float(v)
+            trial["marks"] = marks
+
+    # event times as a sorted float array (in ms) for interval checks
+    events_ms = np.asarray(trial["events"], dtype=np.float64) * 1e3
+    # cumulative sums turn each interval mean below into an O(1) lookup
+    V_cs = np.concatenate(([0.0], np.cumsum(V)))
+    I_cs = np.concatenate(([0.0], np.cumsum(I)))
+
+    # parsing the command steps. Only expected to work for the current
+    # protocols used in this project, which consist of one depolarizing step
+    # (which may be 0 amplitude) and two nested hyperpolarizing steps (e.g.
+    # -50, -100, -50). Each of the intervals is treated differently.
+    padding_samples = int(interval_padding * rate_khz)
+    steady_depol_samples = int(steady_interval_depol * rate_khz)
+    steady_hypol_samples = int(steady_interval_hypol * rate_khz)
+    # locate the baseline, the depolarization (may be absent), and the first
+    # of the two hyperpolarization steps
+    is_zero = step_val == 0
+    zstep = int(np.argmax(is_zero)) if is_zero.any() else None
+    is_depol = step_val > 0
+    dstep = int(np.argmax(is_depol)) if is_depol.any() else 0
+    is_hypol = step_val < 0
+    hstep = int(np.argmax(is_hypol)) if is_hypol.any() else None
+    last = len(step_val) - 1
+    # analysis intervals: first whole baseline, late part of the
+    # depolarization, steady parts of the two hyperpolarization steps, and
+    # the last 300 ms of the final baseline
+    intervals = [
+        Interval(
+            step_start[zstep] + padding_samples,
+            step_end[zstep] - padding_samples,
+            sp_ms,
+        ),
+        Interval(
+            step_end[dstep] - steady_depol_samples,
+            step_end[dstep] - padding_samples,
+            sp_ms,
+        ),
+        Interval(
+            step_end[hstep] - steady_hypol_samples,
+            step_end[hstep] - padding_samples,
+            sp_ms,
+        ),
+        Interval(
+            step_end[hstep + 1] - steady_hypol_samples,
+            step_end[hstep + 1] - padding_samples,
+            sp_ms,
+        ),
+        Interval(
+            step_end[last] - steady_depol_samples,
+            step_end[last] - padding_samples,
+            sp_ms,
+        ),
+    ]
+    # the current means come from one batched lookup; the voltage means are
+    # None for intervals contaminated by spikes
+    steps = {
+        "I": interval_means(I_cs, intervals).tolist(),
+        "V": [iv.mean_of_cs(V_cs, events_ms) for iv in intervals],
+    }
+    trial["steps"] = steps
+    trial["stimulus"] = {"I": steps["I"][1]}
+    if dstep > 0:
+        trial["stimulus"]["interval"] = Interval(
+            step_start[dstep],
+            step_end[dstep],
+            sp_s,
+        ).times
+    # interval for checking for spontaneous spikes is from end of first
+    # depol to end of last hypol
+    trial["spont_interval"] = Interval(
+        step_end[dstep] if dstep > 0 else step_start[0],
+        step_start[last],
+        sp_s,
+    ).times
+    # series and membrane resistance from the two hyperpolarization steps
+    Rs = [
+        series_resistance(
+            I, V, step_start[hstep], padding_samples, int(rate_khz)
+        ),
+        series_resistance(
+            I, V, step_start[hstep + 1], padding_samples, int(rate_khz)
+        ),
+    ]
+    Rm = []
+    try:
+        Rm.append((steps["V"][2] - steps["V"][0]) / (steps["I"][2] - steps["I"][0]))
+    except TypeError:
+        pass
+    try:
+        Rm.append((steps["V"][3] - steps["V"][2]) / (steps["I"][3] - steps["I"][2]))
+    except TypeError:
+        pass
+    # hyperpolarization step 1 is used for the time constant fit, but only if
+    # it was not contaminated by spikes
+    hypol = None
+    if steps["V"][2] is not None:
+        hypol = (
+            I[step_start[hstep] : step_end[hstep]],
+            V[step_start[hstep] : step_end[hstep]],
+        )
+    trial["Rs"] = float(np.mean(Rs))
+    if len(Rm) > 0:
+        # mV/pA -> MΩ
+        trial["Rm"] = float(np.mean(Rm)) * 1e3
+        # resting potential: V = V_0 - I_0 * Rm (pA * MΩ -> mV)
+        if steps["V"][0] is not None:
+            trial["Vm"] = steps["V"][0] - steps["I"][0] * trial["Rm"] * 1e-3
+    return trial, hypol
+
+
+def run_epoch(abf: Path, epoch: int, metadata: dict, args) -> bool:
+    """Analyze one epoch (one ABF file) of a recording and write the pprox output.
+
+    The epochs of a neuron are independent, so sibling files can be processed
+    in parallel; nbank and bird-database lookups are done once by the caller
+    and passed in through *metadata*. Returns True on success so the driver
+    can exit nonzero when a conversion fails.
+
+    """
+    short_name = args.neuron.split("-")[0]
+    output_file = args.output_dir / f"{short_name}_{epoch:02}.pprox"
+    if args.skip_completed and output_file.exists():
+        log.info("- output file %s already exists, skipping", output_file)
+        return True
+
+    log.info("- reading %s", abf)
+    ifp = AxonIO(abf)
+    block = ifp.read_block(lazy=True)
+    protocols = ifp.read_protocol()
+
+    pprox = {
+        "$schema": "https://meliza.org/spec:2/pprox.json#",
+        "cell": short_name,
+        "epoch": epoch,
+        "source": nb.full_url(args.neuron),
+        "abf_file": abf.stem,
+        "timestamp": block.rec_datetime,
+        "units": _units,
+    }
+    pprox.update(**metadata)
+
+    # sweeps are processed concurrently; threads work well here because
+    # numpy and the memmap-backed signal loads release the GIL
+    n_sweeps = len(block.segments)
+    # pool.map zips the sweeps with their protocols, so a short or empty
+    # protocol list (gapfree recording) would silently truncate the epoch
+    if len(protocols) < n_sweeps:
+        log.error("   - error: no protocol information - gapfree?")
+        return False
+    # the sampling rate is uniform across the sweeps of an ABF file, so the
+    # rate, sweep start times, and detector window sizes are all looked up
+    # once here rather than by each worker
+    rate_hz = ifp.get_signal_sampling_rate(0)
+    rate_khz = rate_hz / 1e3
+    t_starts = [
+        ifp.get_signal_t_start(block_index=0, seg_index=i, stream_index=0)
+        for i in range(n_sweeps)
+    ]
+    detector_params = (
+        int(args.rise_ms * rate_khz),
+        int(-args.spike_analysis_window[0] * rate_khz),
+        int(args.spike_analysis_window[1] * rate_khz),
+    )
+    # read the whole block into one contiguous raw buffer in a single
+    # sequential pass over the memmap, then convert to float once; the
+    # workers operate on per-sweep views of the result
+    n_samples = ifp.get_signal_size(block_index=0, seg_index=0, stream_index=0)
+    first = ifp.get_analogsignal_chunk(block_index=0, seg_index=0, stream_index=0)
+    raw = np.empty((n_sweeps, n_samples, first.shape[1]), dtype=first.dtype)
+    raw[0] = first
+    for i in range(1, n_sweeps):
+        raw[i] = ifp.get_analogsignal_chunk(
+            block_index=0, seg_index=i, stream_index=0
+        )
+    block_sigs = ifp.rescale_signal_raw_to_float(
+        raw.reshape(-1, raw.shape[2]), dtype="float64", stream_index=0
+    ).reshape(raw.shape)
+    try:
+        scales = channel_scales(block.segments[0].analogsignals)
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            results = list(
+                pool.map(
+                    process_sweep,
+                    block_sigs,
+                    range(n_sweeps),
+                    t_starts,
+                    protocols,
+                    repeat(scales),
+                    repeat(rate_hz),
+                    repeat(detector_params),
+                    repeat(args),
+                )
+            )
+    except ValueError as err:
+        log.error("   - error: %s", err)
+        return False
+
+    # 2-D buffers for the hyperpolarization steps, allocated once the step
+    # width is known; rows beyond n_hypol are unused (sweeps with spikes)
+    hypol_I = None
+    hypol_V = None
+    n_hypol = 0
+    pprox["pprox"] = []
+    for trial, hypol in results:
+        if hypol is not None:
+            hI, hV = hypol
+            if hypol_I is None:
+                hypol_I = np.empty((n_sweeps, hI.size), dtype=np.float64)
+                hypol_V = np.empty_like(hypol_I)
+            hypol_I[n_hypol] = hI
+            hypol_V[n_hypol] = hV
+            n_hypol += 1
+        pprox["pprox"].append(trial)
+
+    if hypol_I is None:
+        hypol_I = hypol_V = np.empty((0, 0), dtype=np.float64)
+    pprox["stats"] = time_constant(
+        hypol_I[:n_hypol],
+        hypol_V[:n_hypol],
+        dt=1.0 / rate_khz,
+    )
+    # output to json; orjson's C encoder serializes numpy values natively, so
+    # json_serializable is only needed for the Quantity scalars
+    with open(output_file, "wb") as fp:
+        fp.write(
+            orjson.dumps(
+                pprox, default=json_serializable, option=orjson.OPT_SERIALIZE_NUMPY
+            )
+        )
+    log.info("- wrote results to `%s`", output_file)
+    return True
+
+
 if __name__ == "__main__":
     import argparse
 
@@ -130,19 +513,19 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "--rise-ms",
-        type=with_units(pq.ms),
+        type=float,
         default=1.0,
         help="approximate rise time for spikes (default %(default).1f ms)",
     )
     parser.add_argument(
         "--first-spike-amplitude-min",
-        type=with_units(pq.mV),
+        type=float,
         default=30,
         help="minimum amplitude for first spike (default %(default).1f mV)",
     )
     parser.add_argument(
         "--spike-amplitude-min",
-        type=with_units(pq.mV),
+        type=float,
         default=10,
         help="minimum amplitude for subsequent spikes (default %(default).1f mV)",
     )
@@ -154,13 +537,13 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "--spike-thresh-min",
-        type=with_units(pq.mV),
+        type=float,
         default=-50,
         help="alternate minimum threshold for spike detection (default %(default).2f mV)",
     )
     parser.add_argument(
         "--spike-analysis-window",
-        type=with_units(pq.ms),
+        type=float,
         nargs=2,
         default=[-7, 100],
         help="the window around each spike to analyze (default %(default)s ms)",
@@ -183,7 +566,9 @@ if __name__ == "__main__":
         help="ABF protocol channel with current steps used (default %(default)d)",
     )
     parser.add_argument("neuron", help="identifier for the neuron")
-    parser.add_argument("epoch", help="index of the epoch to analyze", type=int)
+    parser.add_argument(
+        "epoch", help="index of the epoch(s) to analyze", type=int, nargs="+"
+    )
     args = parser.parse_args()
     setup_log(log, args.debug)
     log.info("- date: %s", datetime.datetime.now())
@@ -195,32 +580,15 @@ if __name__ == "__main__":
         log.error("  - error: `%s` is not in neurobank registry", args.neuron)
         parser.exit(-1)
     files = sorted(Path(path).glob("*.abf"))
-    try:
-        abf = files[args.epoch - 1]
-    except IndexError:
-        log.error("  - error: there is no epoch %d", args.epoch)
-        parser.exit(-1)
-
-    short_name = args.neuron.split("-")[0]
-    output_file = args.output_dir / f"{short_name}_{args.epoch:02}.pprox"
-    if args.skip_completed and output_file.exists():
-        log.info("- output file %s already exists, skipping", output_file)
-        parser.exit()
-
-    log.info("- reading %s", abf)
-    ifp = AxonIO(abf)
-    block = ifp.read_block(lazy=True)
-    protocols = ifp.read_protocol()
+    epoch_files = []
+    for epoch in args.epoch:
+        try:
+            epoch_files.append(files[epoch - 1])
+        except IndexError:
+            log.error("  - error: there is no epoch %d", epoch)
+            parser.exit(-1)
 
-    pprox = {
-        "$schema": "https://meliza.org/spec:2/pprox.json#",
-        "cell": short_name,
-        "epoch": args.epoch,
-        "source": nb.full_url(args.neuron),
-        "abf_file": abf.stem,
-        "timestamp": block.rec_datetime,
-        "units": _units,
-    }
+    metadata = {}
     try:
         url = f"{birddb_url}{info['metadata']['bird']}/"
         birb = rq.get(url).json()
@@ -231,239 +599,20 @@ if __name__ == "__main__":
     except (KeyError, rq.HTTPError):
         pass
     else:
-        pprox.update(**info["metadata"])
-
-    hypol_I = []
-    hypol_V = []
+        metadata = info["metadata"]
 
-    pprox["pprox"] = []
-    for sweep_idx, segment in enumerate(block.segments):
-        log.debug("- sweep %d:", sweep_idx)
-        sampling_rate = segment.analogsignals[0].sampling_rate.rescale("kHz")
-        sampling_period = segment.analogsignals[0].sampling_period.rescale("ms")
-        try:
-            V = (
-                (segment.analogsignals[0].load() - junction_potential)
-                .rescale(_units["voltage"])
-                .squeeze()
-                .magnitude
-            )
-        except ValueError:
-            log.error(
-                "   - error: not a current clamp recording (signal 0 units not voltage)"
-            )
-            parser.exit(-1)
-        try:
-            I = (
-                segment.analogsignals[1]
-                .load()
-                .rescale(_units["current"])
-                .squeeze()
-                .magnitude
-            )
-        except ValueError:
-            log.error(
-                "   - error: not a current clamp recording (signal 1 units not current)"
-            )
+    if len(epoch_files) == 1:
+        if not run_epoch(epoch_files[0], args.epoch[0], metadata, args):
             parser.exit(-1)
-        try:
-            Ic = (
-                protocols[sweep_idx]
-                .analogsignals[args.command_channel]
-                .rescale(_units["current"])
-                .squeeze()
-                .magnitude
-            )
-        except IndexError:
-            log.error(
-                "   - error: no protocol information - gapfree?",
-            )
-            parser.exit(-1)
-        except ValueError:
-            log.error(
-                "   - error: protocol channel %d is not in units of current",
-                args.command_channel,
-            )
-            parser.exit(-1)
-        try:
-            T = segment.analogsignals[2].load().rescale(_units["temperature"]).mean()
-        except ValueError:
-            T = None
-        # values are truncated to make finding zeros easier
-        step_len, step_start, step_val = qst.runlength_encode(Ic.astype("i"))
-        step_end = step_start + step_len
-        if len(step_len) == 0:
-            log.error(
-                "   - error: protocol channel %d does not have any current steps",
-                args.command_channel,
+    else:
+        # run sibling epochs in parallel, amortizing startup and nbank lookup
+        with multiprocessing.Pool(os.cpu_count()) as pool:
+            succeeded = pool.starmap(
+                run_epoch,
+                [
+                    (abf, epoch, metadata, args)
+                    for abf, epoch in zip(epoch_files, args.epoch)
+                ],
             )
+        if not all(succeeded):
             parser.exit(-1)
-
-        trial = {
-            "index": sweep_idx,
-            "offset": segment.t_start,
-            "events": [],
-            "interval": [0.0 * pq.s, segment.t_stop - segment.t_start],
-            "temperature": T,
-            # "stimulus": list(
-            #     summarize_currents(I, step_start, step_len, sampling_period)
-            # ),
-        }
-        if args.compute_stats:
-            trial["marks"] = defaultdict(list)
-
-        # detect spikes
-        # we set the threshold based on the amplitude of the first spike
-        n_rise = int(args.rise_ms * sampling_rate)
-        n_before = int(-args.spike_analysis_window[0] * sampling_rate)
-        n_after = int(args.spike_analysis_window[1] * sampling_rate)
-        detector = SpikeFinder(n_rise, n_before, n_after)
-        first_spike = detector.calculate_threshold(
-            V, args.spike_thresh_rel, args.spike_thresh_min
-        )
-        if first_spike is None:
-            log.debug("  ✗ no spikes")
-        elif (
-            first_spike.peak_V - first_spike.takeoff_V
-            < args.first_spike_amplitude_min * pq.mV
-        ):
-            log.debug("  ✗ first spike amplitude is too low")
-        else:
-            trial["first_spike"] = dict(
-                base=first_spike.takeoff_V,
-                thresh=detector.spike_thresh,
-                width=(first_spike.half_rise_t + first_spike.half_decay_t)
-                * sampling_period,
-                trough_t=first_spike.trough_t * sampling_period,
-            )
-            for time, spike in detector.extract_spikes(
-                V, args.spike_amplitude_min, args.spike_upsample
-            ):
-                trial["events"].append(time * sampling_period.rescale("s"))
-                if args.compute_stats:
-                    shape = spike_shape(spike, sampling_period)
-                    for k, v in zip(shape._fields, shape):
-                        trial["marks"][k].append(v)
-
-        # parsing the command steps. Only expected to work for the current
-        # protocols used in this project, which consist of one depolarizing step
-        # (which may be 0 amplitude) and two nested hyperpolarizing steps (e.g.
-        # -50, -100, -50). Each of the intervals is treated differently.
-        steps = {"I": [], "V": []}
-        # baseline: use the first whole interval
-        padding_samples = int(interval_padding * sampling_rate)
-        steady_depol_samples = int(steady_interval_depol * sampling_rate)
-        steady_hypol_samples = int(steady_interval_hypol * sampling_rate)
-        step = first_index(lambda x: x == 0, step_val)
-        interval = Interval(
-            step_start[step] + padding_samples,
-            step_end[step] - padding_samples,
-            sampling_period,
-        )
-        steps["I"].append(interval.mean_of(I))
-        steps["V"].append(interval.mean_of(V, trial["events"]))
-        # depolarization: use the last part. voltage is nan if there are spikes
-        # duplicate the first step if there's no depolarization
-        dstep = first_index(lambda x: x > 0, step_val) or 0
-        interval = Interval(
-            step_end[dstep] - steady_depol_samples,
-            step_end[dstep] - padding_samples,
-            sampling_period,
-        )
-        steps["I"].append(interval.mean_of(I))
-        steps["V"].append(interval.mean_of(V, trial["events"]))
-        trial["stimulus"] = {"I": steps["I"][-1]}
-        if dstep > 0:
-            trial["stimulus"]["interval"] = Interval(
-                step_start[dstep],
-                step_end[dstep],
-                sampling_period.rescale("s"),
-            ).times
-        # hyperpolarization 1
-        Rm = []
-        Rs = []
-        step = first_index(lambda x: x < 0, step_val)
-        interval = Interval(
-            step_end[step] - steady_hypol_samples,
-            step_end[step] - padding_samples,
-            sampling_period,
-        )
-        Rs.append(
-            series_resistance(
-                I, V, step_start[step], padding_samples, int(sampling_rate * pq.ms)
-            )
-        )
-        Vstep = interval.mean_of(V, trial["events"])
-        steps["I"].append(interval.mean_of(I))
-        steps["V"].append(Vstep)
-        if Vstep is not None:
-            hypol_I.append(I[step_start[step] : step_end[step]])
-            hypol_V.append(V[step_start[step] : step_end[step]])
-        try:
-            Rm.append(
-                (steps["V"][-1] - steps["V"][0]) / (steps["I"][-1] - steps["I"][0])
-            )
-        except TypeError:
-            pass
-        # hyperpolarization step 2
-        step = step + 1
-        interval = Interval(
-            step_end[step] - steady_hypol_samples,
-            step_end[step] - padding_samples,
-            sampling_period,
-        )
-        Rs.append(
-            series_resistance(
-                I, V, step_start[step], padding_samples, int(sampling_rate * pq.ms)
-            )
-        )
-        Vstep = interval.mean_of(V, trial["events"])
-        steps["I"].append(interval.mean_of(I))
-        steps["V"].append(Vstep)
-        try:
-            Rm.append(
-                (steps["V"][-1] - steps["V"][-2]) / (steps["I"][-1] - steps["I"][-2])
-            )
-        except TypeError:
-            pass
-        trial["steps"] = steps
-        # last step is another baseline. Use last 300 ms
-        step = len(step_val) - 1
-        interval = Interval(
-            step_end[step] - steady_depol_samples,
-            step_end[step] - padding_samples,
-            sampling_period,
-        )
-        # interval for checking for spontaneous spikes is from end of first
-        # depol to end of last hypol
-        trial["spont_interval"] = Interval(
-            step_end[dstep] if dstep > 0 else step_start[0],
-            step_start[step],
-            sampling_period.rescale("s"),
-        ).times
-        steps["I"].append(interval.mean_of(I))
-        steps["V"].append(interval.mean_of(V, trial["events"]))
-        # average Rs and Rm from the two hyperpolarization steps
-        trial["Rs"] = (np.mean(Rs) * _units["voltage"] / _units["current"]).rescale(
-            _units["resistance"]
-        )
-        if len(Rm) > 0:
-            trial["Rm"] = (np.mean(Rm) * _units["voltage"] / _units["current"]).rescale(
-                _units["resistance"]
-            )
-            # resting potential: V = V_0 - I_0 * Rm
-            if steps["V"][0] is not None:
-                trial["Vm"] = (
-                    steps["V"][0] * _units["voltage"]
-                    - steps["I"][0] * _units["current"] * trial["Rm"]
-                )
-        pprox["pprox"].append(trial)
-
-    pprox["stats"] = time_constant(
-        hypol_I, hypol_V, dt=sampling_period.rescale(_units["time"])
-    )
-    # output to json
-    output_file = args.output_dir / f"{short_name}_{args.epoch:02}.pprox"
-    with open(output_file, "wt") as fp:
-        json.dump(pprox, fp, default=json_serializable)
-    log.info("- wrote results to `%s`", output_file)
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 # -*- mode: python -*-
 import logging
-from functools import singledispatch
+from functools import lru_cache
 from typing import Iterable, Optional, Tuple
 
 import numpy as np
@@ -34,8 +34,12 @@ def setup_log(log, debug=False):
     log.addHandler(ch)
 
 
-def with_units(unit: pq.UnitQuantity):
-    return lambda x: x * unit
+@lru_cache(maxsize=None)
+def locate_resource(resource_id: str, registry_url: Optional[str] = None):
+    """Look up the local path of a neurobank resource, caching repeat lookups"""
+    import nbank as nb
+
+    return nb.get(resource_id, registry_url, local_only=True)
 
 
 def first_index(fn, seq):
@@ -50,6 +54,8 @@ class Interval:
         self.start_index = start_index
         self.end_index = end_index
         self.sampling_period = sampling_period
+        self._t0 = float(start_index * sampling_period)
+        self._t1 = float(end_index * sampling_period)
 
     @property
     def slice(self) -> slice:
@@ -62,43 +68,70 @@ class Interval:
             self.end_index * self.sampling_period,
         )
 
-    def contains(self, events: Iterable[float]) -> bool:
-        start, end = self.times
-        return any((ev >= start and ev < end) for ev in events)
+    def contains(self, events: np.ndarray) -> bool:
+        """True if any event falls in the interval.
+
+        *events* must be a sorted array of times in the same units as
+        sampling_period.
+        """
+        i = np.searchsorted(events, self._t0)
+        return bool(i < events.size and events[i] < self._t1)
 
     def mean_of(
-        self, timeseries: np.ndarray, events: Optional[Iterable[float]] = None
+        self, timeseries: np.ndarray, events: Optional[np.ndarray] = None
     ) -> Optional[float]:
         if events is not None and self.contains(events):
             return None
         return timeseries[self.slice].mean()
 
+    def mean_of_cs(
+        self, cumsum: np.ndarray, events: Optional[np.ndarray] = None
+    ) -> Optional[float]:
+        """Mean over the interval from a precomputed cumulative sum.
 
-@singledispatch
-def json_serializable(val):
-    """Serialize a value for the json module."""
-    return str(val)
-
+        *cumsum* must be the cumulative sum of the timeseries with a zero
+        prepended (i.e. ``np.concatenate(([0.0], np.cumsum(x)))``), which
+        makes each mean an O(1) difference instead of a fresh reduction.
+        """
+        if events is not None and self.contains(events):
+            return None
+        n = self.end_index - self.start_index
+        return (cumsum[self.end_index] - cumsum[self.start_index]) / n
 
-@json_serializable.register(pq.UnitQuantity)
-def __js_quantity(val):
-    """Used for scalar quantities with units"""
-    return val.symbol
 
+def interval_means(cumsum: np.ndarray, intervals: Iterable["Interval"]) -> np.ndarray:
+    """Means of a timeseries over multiple intervals.
 
-@json_serializable.register(pq.Quantity)
-def __js_quantity(val):
-    """Used for scalar quantities with units"""
-    return val.magnitude.item()
+    *cumsum* is a precomputed cumulative sum with a zero prepended (see
+    Interval.mean_of_cs); the sums for all of the intervals come from a
+    single batched lookup.
+    """
+    starts = np.fromiter((iv.start_index for iv in intervals), dtype=np.intp)
+    ends = np.fromiter((iv.end_index for iv in intervals), dtype=np.intp)
+    return (cumsum[ends] - cumsum[starts]) / (ends - starts)
 
 
-@json_serializable.register(np.generic)
-def __js_numpy(val):
-    """Used if *val* is an instance of a numpy scalar."""
-    return val.item()
+# serialization functions by type, most specific first; exact types hit the
+# dict directly, subclasses are resolved once and cached
+_json_dispatch = {
+    pq.UnitQuantity: lambda val: val.symbol,
+    pq.Quantity: lambda val: val.magnitude.item(),
+    np.generic: lambda val: val.item(),
+    np.ndarray: lambda arr: arr.tolist(),
+}
 
 
-@json_serializable.register(np.ndarray)
-def __js_numpy_arr(arr):
-    """Used if *arr* is an instance of a numpy array."""
-    return arr.tolist()
+def json_serializable(val):
+    """Serialize a value for the json module."""
+    cls = type(val)
+    try:
+        fn = _json_dispatch[cls]
+    except KeyError:
+        for base, candidate in _json_dispatch.items():
+            if isinstance(val, base):
+                fn = candidate
+                break
+        else:
+            fn = str
+        _json_dispatch[cls] = fn
+    return fn(val)
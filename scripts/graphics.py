@@ -59,6 +59,7 @@ class AnchoredScaleBar(AnchoredOffsetbox):
         - sep : separation between labels and bars in points.
         - **kwargs : additional arguments passed to base class constructor
         """
+        from matplotlib.lines import Line2D
         from matplotlib.offsetbox import (
             AuxTransformBox,
             DrawingArea,
@@ -66,16 +67,17 @@ class AnchoredScaleBar(AnchoredOffsetbox):
             TextArea,
             VPacker,
         )
-        from matplotlib.patches import Rectangle
 
+        # plain lines render faster than the degenerate zero-height/width
+        # Rectangles used previously, especially on the pdf backend
         bars = AuxTransformBox(transform)
         if sizex:
             bars.add_artist(
-                Rectangle((0, 0), sizex, 0, ec=barcolor, lw=barwidth, fc="none")
+                Line2D([0, sizex], [0, 0], color=barcolor, lw=barwidth)
             )
         if sizey:
             bars.add_artist(
-                Rectangle((0, 0), 0, sizey, ec=barcolor, lw=barwidth, fc="none")
+                Line2D([0, 0], [0, sizey], color=barcolor, lw=barwidth)
             )
 
         if sizex and labelx:
@@ -148,6 +150,36 @@ def hide_axes(*axes):
         ax.set_frame_on(False)
 
 
+def spike_raster(ax, events, height=0.8, **kwargs):
+    """Plot a spike raster as a single LineCollection.
+
+    *events* is a sequence of arrays of spike times, one row per sweep. Each
+    row's ticks take the next color in the property cycle, matching traces
+    plotted on sibling axes, and tick height is set in data coordinates.
+    Additional keyword arguments are passed to the collection. Returns the
+    created collection.
+    """
+    import numpy as np
+    from matplotlib.collections import LineCollection
+
+    cycle = mpl.rcParams["axes.prop_cycle"].by_key()["color"]
+    times = []
+    colors = []
+    for i, ev in enumerate(events):
+        times.append(np.asarray(ev, dtype="d"))
+        colors.extend([cycle[i % len(cycle)]] * len(ev))
+    t = np.concatenate(times) if times else np.empty(0)
+    y = np.repeat(np.arange(len(events), dtype="d"), [len(ev) for ev in times])
+    segments = np.empty((t.size, 2, 2))
+    segments[:, :, 0] = t[:, None]
+    segments[:, 0, 1] = y - height / 2
+    segments[:, 1, 1] = y + height / 2
+    lc = LineCollection(segments, colors=colors, **kwargs)
+    ax.add_collection(lc)
+    ax.set_ylim(-0.5, len(events) - 0.5)
+    return lc
+
+
 def adjust_raster_ticks(ax, gap=0):
     """Adjust raster marks to have gap pixels between them (sort of)"""
     miny, maxy = ax.get_ylim()
@@ -157,16 +189,18 @@ def adjust_raster_ticks(ax, gap=0):
 
 
 def offset_traces(ax, annotate=False):
-    data_ranges = [x.get_ydata().ptp() for x in ax.lines]
-    step = max(data_ranges)
-    offset = 0
+    import numpy as np
+
+    # stack the traces so the ranges come from one reduction and each line's
+    # data is only read once
+    Y = np.stack([line.get_ydata() for line in ax.lines])
+    step = (Y.max(axis=1) - Y.min(axis=1)).max()
     # these should be in order of insertion
     for i, line in enumerate(ax.lines):
-        x = line.get_xdata()
-        y = line.get_ydata()
-        line.set_ydata(y + offset)
+        y = Y[i]
+        line.set_ydata(y + i * step)
         if annotate:
-            ax.text(x[0], y[0] + offset, "%.0f" % y[0], fontsize=7, ha="right")
-        offset += step
+            x = line.get_xdata()
+            ax.text(x[0], y[0] + i * step, "%.0f" % y[0], fontsize=7, ha="right")
     ylim = ax.get_ylim()
-    ax.set_ylim((ylim[0], ylim[1] + offset))
+    ax.set_ylim((ylim[0], ylim[1] + len(ax.lines) * step))
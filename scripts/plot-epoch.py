@@ -6,15 +6,23 @@
 import datetime
 import json
 import logging
+import sys
 from pathlib import Path
 
+import matplotlib
+
+# select the non-interactive backend before pyplot pulls in a GUI toolkit;
+# only possible to do this before the first pyplot import
+if any(arg in ("-O", "--output") or arg.startswith("--output=") for arg in sys.argv):
+    matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 import nbank as nb
+from matplotlib.collections import LineCollection
 import numpy as np
 from neo import AxonIO
 
-from core import _units, junction_potential, setup_log
-from graphics import add_scalebar, adjust_raster_ticks, hide_axes, offset_traces
+from core import _units, junction_potential, locate_resource, setup_log
+from graphics import add_scalebar, hide_axes, spike_raster
 
 log = logging.getLogger("plot-epoch")
 __version__ = "20221006"
@@ -23,8 +31,6 @@ __version__ = "20221006"
 if __name__ == "__main__":
     import argparse
 
-    # matplotlib.use("Agg", warn=False)
-
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--debug", help="show verbose log messages", action="store_true"
@@ -79,10 +85,22 @@ if __name__ == "__main__":
         pprox = json.load(fp)
     log.info("- neuron resource: %s", pprox["source"])
     registry_url, resource_id = nb.parse_resource_id(pprox["source"])
-    resource_path = nb.get(resource_id, registry_url, local_only=True)
+    resource_path = locate_resource(resource_id, registry_url)
     abf_path = (Path(resource_path) / pprox["abf_file"]).with_suffix(".abf")
 
     log.info("- abf file: %s", abf_path)
+    if args.output is not None:
+        # skip the expensive ABF read and render if the target is up to date
+        out = (
+            (args.output / args.epoch.stem).with_suffix(".pdf")
+            if args.output.is_dir()
+            else args.output
+        )
+        if out.exists():
+            out_mtime = out.stat().st_mtime
+            if out_mtime > abf_path.stat().st_mtime and out_mtime > args.epoch.stat().st_mtime:
+                log.info("- %s is up to date, skipping", out)
+                sys.exit(0)
     ifp = AxonIO(abf_path)
     block = ifp.read_block(lazy=True)
 
@@ -92,39 +110,65 @@ if __name__ == "__main__":
     s_ax = fig.add_axes((0.06, 0.80, 0.9, 0.10))
     v_ax = fig.add_axes((0.06, 0.17, 0.9, 0.68), sharex=s_ax)
     i_ax = fig.add_axes((0.06, 0.05, 0.9, 0.10), sharex=s_ax)
+    raster = []
+    voltages = []
+    currents = []
+    times = []
+    # scalar unit-conversion factors, computed once; working on magnitude
+    # views avoids the intermediate Quantity arrays of subtract/rescale
+    first_sigs = block.segments[0].analogsignals
+    k_v = float((1 * first_sigs[0].units).rescale(_units["voltage"]).magnitude)
+    k_i = float((1 * first_sigs[1].units).rescale(_units["current"]).magnitude)
+    jp = float(junction_potential.rescale(_units["voltage"]).magnitude)
+    period_ms = float(first_sigs[0].sampling_period.rescale("ms").magnitude)
     for sweep_idx, segment in enumerate(block.segments):
         log.debug("- sweep %d:", sweep_idx)
-        sampling_rate = segment.analogsignals[0].sampling_rate.rescale("kHz")
-        sampling_period = segment.analogsignals[0].sampling_period.rescale("ms")
         # we can be fairly confident the signals are okay because this was
         # processed with abf2pprox
-        V = (segment.analogsignals[0].load() - junction_potential).rescale(
-            _units["voltage"]
+        V = segment.analogsignals[0].load().magnitude.squeeze() * k_v - jp
+        I = segment.analogsignals[1].load().magnitude.squeeze() * k_i
+        voltages.append(V)
+        currents.append(I)
+        times.append(np.arange(V.size) * period_ms)
+        raster.append(np.asarray(pprox["pprox"][sweep_idx]["events"]) * 1000)
+    # all of the spikes go into one collection, colored to match the traces
+    spike_raster(s_ax, raster)
+
+    cycle = plt.rcParams["axes.prop_cycle"].by_key()["color"]
+    trace_colors = [cycle[i % len(cycle)] for i in range(nsweeps)]
+    if not args.combine:
+        # offset the traces vertically and label the resting potentials
+        step = max(V.max() - V.min() for V in voltages)
+        for i, (t, V) in enumerate(zip(times, voltages)):
+            v_ax.text(t[0], V[0] + i * step, "%.0f" % V[0], fontsize=7, ha="right")
+        voltages = [V + i * step for i, V in enumerate(voltages)]
+    # one collection per axis instead of one Line2D per sweep, so transform
+    # updates and autoscaling run once; rasterized so vector output stays
+    # small
+    v_ax.add_collection(
+        LineCollection(
+            [np.column_stack([t, V]) for t, V in zip(times, voltages)],
+            colors=trace_colors,
+            rasterized=True,
         )
-        I = (
-            segment.analogsignals[1]
-            .load()
-            .rescale(_units["current"])
-            .squeeze()
-            .magnitude
+    )
+    i_ax.add_collection(
+        LineCollection(
+            [np.column_stack([t, I]) for t, I in zip(times, currents)],
+            colors=trace_colors,
+            rasterized=True,
         )
-        t = (V.times - V.t_start).rescale("ms")
-        V = V.squeeze().magnitude
-        v_ax.plot(t, V)
-        i_ax.plot(t, I)
-
-        spikes = np.asarray(pprox["pprox"][sweep_idx]["events"]) * 1000
-        s_ax.plot(spikes, [sweep_idx] * len(spikes), "|")
+    )
+    v_ax.autoscale_view()
+    i_ax.autoscale_view()
 
     title = "{cell}_{epoch}".format(**pprox)
     fig.text(0.5, 0.95, title, ha="center")
     # tidy up the spikes
     s_ax.set_ylim(0 - 0.5, nsweeps + 0.5)
-    adjust_raster_ticks(s_ax, gap=1)
     hide_axes(s_ax)
     # standardize voltage axis
     if not args.combine:
-        offset_traces(v_ax, annotate=True)
         add_scalebar(
             v_ax,
             barcolor="black",
@@ -154,8 +198,8 @@ if __name__ == "__main__":
     elif args.output.is_dir():
         path = (args.output / args.epoch.stem).with_suffix(".pdf")
         log.info("- saving plot to %s", path)
-        fig.savefig(path)
+        fig.savefig(path, dpi=150)
     else:
         path = args.output
         log.info("- saving plot to %s", path)
-        fig.savefig(path)
+        fig.savefig(path, dpi=150)
@@ -4,19 +4,27 @@
 import datetime
 import json
 import logging
+import sys
 from pathlib import Path
 
+import matplotlib
+
+# select the non-interactive backend before pyplot pulls in a GUI toolkit;
+# only possible to do this before the first pyplot import
+if any(arg in ("-O", "--output") or arg.startswith("--output=") for arg in sys.argv):
+    matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+import quantities as pq
 
-from core import junction_potential, setup_log
+from core import junction_potential, locate_resource, setup_log
 from graphics import (
     add_scalebar,
-    adjust_raster_ticks,
     hide_axes,
     offset_traces,
     simple_axes,
+    spike_raster,
 )
 
 log = logging.getLogger("plot-plasticity")
@@ -29,7 +37,7 @@ def load_abf(pprox):
     from neo.io import AxonIO
 
     registry_url, resource_id = nb.parse_resource_id(pprox["source"])
-    resource_path = nb.get(resource_id, registry_url, local_only=True)
+    resource_path = locate_resource(resource_id, registry_url)
     abf_path = (Path(resource_path) / pprox["abf_file"]).with_suffix(".abf")
     ifp = AxonIO(abf_path)
     return ifp.read_block(lazy=True)
@@ -69,16 +77,38 @@ if __name__ == "__main__":
     args = parser.parse_args()
     setup_log(log, args.debug)
 
-    iv_stats = pd.read_csv(
-        args.build_dir / "iv_stats.csv", index_col=["cell", "epoch", "sweep"]
+    if args.output is not None:
+        # skip the CSV parsing, ABF reads, and render if the target is newer
+        # than all of the stats tables
+        out = (
+            (args.output / f"{args.cell}_plasticity").with_suffix(".pdf")
+            if args.output.is_dir()
+            else args.output
+        )
+        inputs = [
+            args.build_dir / "iv_stats.csv",
+            args.build_dir / "sweep_stats.csv",
+            args.build_dir / "epoch_stats.csv",
+            args.epoch_list,
+        ]
+        if out.exists() and all(
+            out.stat().st_mtime > p.stat().st_mtime for p in inputs
+        ):
+            log.info("- %s is up to date, skipping", out)
+            sys.exit(0)
+
+    # pyarrow's multithreaded reader parses these much faster than the
+    # default C engine; the index is set after the fact
+    iv_stats = pd.read_csv(args.build_dir / "iv_stats.csv", engine="pyarrow").set_index(
+        ["cell", "epoch", "sweep"]
     )
     sweep_stats = pd.read_csv(
-        args.build_dir / "sweep_stats.csv", index_col=["cell", "epoch", "sweep"]
-    )
+        args.build_dir / "sweep_stats.csv", engine="pyarrow"
+    ).set_index(["cell", "epoch", "sweep"])
     epoch_stats = pd.read_csv(
-        args.build_dir / "epoch_stats.csv", index_col=["cell", "epoch"]
-    )
-    epoch_list = pd.read_csv(args.epoch_list, index_col=["cell"])
+        args.build_dir / "epoch_stats.csv", engine="pyarrow"
+    ).set_index(["cell", "epoch"])
+    epoch_list = pd.read_csv(args.epoch_list, engine="pyarrow").set_index("cell")
     epoch_list.index = [x.split("-")[0] for x in epoch_list.index]
 
     epoch_idx = epoch_list.loc[args.cell].epoch
@@ -94,7 +124,13 @@ if __name__ == "__main__":
         ["epoch", pd.cut(steps.current, bins, labels=False)]
     ).mean()
 
-    fig = plt.figure(figsize=(7.5, 5))
+    # only this window of the example traces is displayed, so only this much
+    # of each sweep needs to be read from the ABF file
+    trace_window = (0.1, 2.3)
+
+    # no layout engine: the axes positions are fixed, and a constrained or
+    # tight layout would recompute on every artist change
+    fig = plt.figure(figsize=(7.5, 5), layout=None)
     subfigs = fig.subfigures(1, 3, wspace=0.02)
 
     axes = subfigs[1].subplots(2, sharex=True)
@@ -156,32 +192,43 @@ if __name__ == "__main__":
         pprox = args.build_dir / "{}_{:02}.pprox".format(args.cell, eidx)
         with open(pprox, "rt") as fp:
             epoch = json.load(fp)
-        for idx, pproc in enumerate(epoch["pprox"]):
-            s_ax.plot(pproc["events"], [idx] * len(pproc["events"]), "|")
-        adjust_raster_ticks(s_ax, gap=2)
+        spike_raster(s_ax, [p["events"] for p in epoch["pprox"]])
+        # the raster limits are final; don't re-autoscale on later draws
+        s_ax.set_autoscale_on(False)
+        colors = matplotlib.rcParams["axes.prop_cycle"].by_key()["color"]
 
         block = load_abf(epoch)
+        # scalar unit-conversion factors; working on magnitude views avoids
+        # the intermediate Quantity arrays of subtract/rescale
+        first_sigs = block.segments[0].analogsignals
+        k_v = float((1 * first_sigs[0].units).rescale("mV").magnitude)
+        k_i = float((1 * first_sigs[1].units).rescale("pA").magnitude)
+        jp = float(junction_potential.rescale("mV").magnitude)
         for sidx in args.sweeps:
             segment = block.segments[sidx]
-            V = (segment.analogsignals[0].load() - junction_potential).rescale("mV")
-            I = segment.analogsignals[1].load().rescale("pA")
-            color = s_ax.lines[sidx].get_color()
-            t = V.times - V.t_start
-            v_ax.plot(t, V.magnitude, color=color)
-            i_ax.plot(t, I, color=color)
+            t0 = segment.analogsignals[0].t_start
+            window = (t0 + trace_window[0] * pq.s, t0 + trace_window[1] * pq.s)
+            sig = segment.analogsignals[0].load(time_slice=window)
+            V = sig.magnitude.squeeze() * k_v - jp
+            I = segment.analogsignals[1].load(time_slice=window).magnitude.squeeze() * k_i
+            color = colors[sidx % len(colors)]
+            t = (sig.times - t0).rescale("s").magnitude
+            # rasterize the dense traces so the vector output stays small
+            v_ax.plot(t, V, color=color, rasterized=True)
+            i_ax.plot(t, I, color=color, rasterized=True)
         offset_traces(v_ax)
         aidx += 3
     hide_axes(axes[0], axes[3])
     simple_axes(axes[1], axes[2], axes[4], axes[5])
-    axes[0].set_xlim(0.1, 2.3)
+    axes[0].set_xlim(*trace_window)
 
     if args.output is None:
         plt.show()
     elif args.output.is_dir():
         path = (args.output / f"{args.cell}_plasticity").with_suffix(".pdf")
         log.info("- saving plot to %s", path)
-        fig.savefig(path)
+        fig.savefig(path, dpi=150)
     else:
         path = args.output
         log.info("- saving plot to %s", path)
-        fig.savefig(path)
+        fig.savefig(path, dpi=150)
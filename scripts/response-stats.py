@@ -3,199 +3,332 @@
 # -*- mode: python -*-
 """Compute electrophysiology stats from epoch pprox files """
 import datetime
-import json
 import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
 
 import numpy as np
+import orjson
 import pandas as pd
-from pandarallel import pandarallel
 
 from core import setup_log
 
-pandarallel.initialize(progress_bar=True)
 log = logging.getLogger()
 __version__ = "20230105"
 
 
 def load_epoch(path):
     log.debug(" - reading %s", path)
-    with open(path, "rt") as fp:
-        data = json.load(fp)
-        epoch = pd.json_normalize(
-            data,
-            "pprox",
-            [
-                "cell",
-                "epoch",
-                "bird",
-                "age",
-                "sex",
-                "sire",
-                "dam",
-                "timestamp",
-                ["stats", "tau"],
-                ["stats", "Cm"],
-            ],
-        )
-        return (
-            epoch.rename(
-                columns={"index": "sweep", "stats.tau": "tau", "stats.Cm": "Cm"}
-            )
-            .set_index(["cell", "epoch", "sweep"])
-            .drop(columns=["interval"])
-        )
+    with open(path, "rb") as fp:
+        data = orjson.loads(fp.read())
+    # flatten the trials by hand (json_normalize walks the records much more
+    # slowly); nested fields get the same dotted names it would produce.
+    # from_records fills keys that only some trials carry (first_spike,
+    # stimulus fields on sub-rheobase sweeps) with NaN
+    rows = []
+    for trial in data["pprox"]:
+        row = {}
+        for key, val in trial.items():
+            if key == "interval":
+                continue
+            if isinstance(val, dict):
+                for subkey, subval in val.items():
+                    row[f"{key}.{subkey}"] = subval
+            else:
+                row[key] = val
+        rows.append(row)
+    epoch = pd.DataFrame.from_records(rows).rename(columns={"index": "sweep"})
+    epoch["cell"] = data["cell"]
+    epoch["epoch"] = data["epoch"]
+    for key in ("bird", "age", "sex", "sire", "dam", "timestamp"):
+        epoch[key] = data[key]
+    epoch["tau"] = data["stats"]["tau"]
+    epoch["Cm"] = data["stats"]["Cm"]
+    return epoch.set_index(["cell", "epoch", "sweep"])
 
 
-def sweep_iv_stats(sweep):
-    """Extract IV data from sweeps"""
-    nsteps = len(sweep["steps.I"])
-    return pd.Series(
-        np.concatenate([sweep["steps.I"], sweep["steps.V"]]),
-        index=pd.MultiIndex.from_product(
+def sweep_iv_stats(sweeps):
+    """Extract IV data from all sweeps as a (sweep, (value, step)) table"""
+    # all sweeps have the same number of steps, so the per-sweep lists stack
+    # into two dense arrays (None for spike-contaminated steps becomes NaN).
+    # 32-bit floats are ample precision for 16-bit ADC data and halve the
+    # bandwidth of the median/deviance passes downstream
+    I = np.stack(sweeps["steps.I"].to_list()).astype(np.float32)
+    V = np.stack(sweeps["steps.V"].to_list()).astype(np.float32)
+    nsteps = I.shape[1]
+    # hand pandas a Fortran-ordered matrix: the frame's block then stores
+    # each (value, step) column contiguously, which is the access pattern of
+    # the grouped median/deviance reductions downstream
+    return pd.DataFrame(
+        np.asfortranarray(np.concatenate([I, V], axis=1)),
+        index=sweeps.index,
+        columns=pd.MultiIndex.from_product(
             [["current", "voltage"], range(nsteps)], names=["value", "step"]
         ),
     )
 
 
-def iv_deviation(sweep_steps):
-    """Determine absolute deviation from median (in MADs)"""
-    dev = (sweep_steps - sweep_steps.median()).abs()
-    return dev / dev.median()
-
-
-def iv_slope_rest(iv_stats, frac=0.7, bin_data=False):
-    """Get dV/dI (input resistance) around I=0. Uses loess regression for local interpolation"""
-    from loess.loess_1d import loess_1d
-
+def iv_slope_rest(iv_stats, window=15.0):
+    """Get dV/dI (input resistance) around I=0 from a weighted local linear fit"""
     log.debug(
         "  - analyzing I-V slope for %s_%02d",
         iv_stats.index[0][0],
         iv_stats.index[0][1],
     )
-    I_min = iv_stats.current.min()
-    I_max = iv_stats.current.max()
-    # loess regression may fail horribly if the data are not binned
-    if bin_data:
-        bins = pd.interval_range(np.floor(I_min), np.ceil(I_max))
-        cuts = pd.cut(iv_stats.current, bins)
-        binned = iv_stats.groupby(cuts).agg("mean").dropna()
-    else:
-        binned = iv_stats
-    # interpolate right around I=0, with slight weight toward depolarized voltages
-    xnew = np.arange(-5, 10, 0.1)
-    try:
-        xout, yout, _ = loess_1d(
-            binned.current.to_numpy(),
-            binned.voltage.to_numpy(),
-            xnew=xnew,
-            degree=1,
-            frac=frac,
-            npoints=None,
-            rotate=False,
-            sigy=None,
-        )
-    except SystemError:
+    # fit a line to the points near I=0, with slight weight toward
+    # depolarized voltages
+    mask = (
+        (iv_stats.current > -window)
+        & (iv_stats.current < window)
+        & iv_stats.voltage.notna()
+    )
+    if mask.sum() < 2:
         log.warning(
-            "  - loess failed to converge for %s_%02d",
+            "  - too few points near I=0 for %s_%02d",
             iv_stats.index[0][0],
             iv_stats.index[0][1],
         )
         return np.nan
-    smoothed = pd.DataFrame({"current": xout, "voltage": yout})
-    return (smoothed.voltage.diff() / smoothed.current.diff()).mean() * 1000
+    current = iv_stats.current[mask].to_numpy()
+    voltage = iv_stats.voltage[mask].to_numpy()
+    w = np.exp(-((current - 2.5) ** 2) / 50)
+    slope, _ = np.polyfit(current, voltage, 1, w=w)
+    return slope * 1000
+
 
+def sweep_firing_stats(sweeps):
+    """Compute firing statistics for all sweeps.
 
-def sweep_firing_stats(sweep):
+    Everything is computed as whole columns; the only per-sweep work is a
+    pair of binary searches per window, which fill preallocated
+    count/first/last arrays. Spike containment matches pd.Interval's
+    default closed="right".
+    """
+    n = sweeps.shape[0]
+    # stimulus interval bounds; sweeps without step info get NaN bounds,
+    # which make the window searches below empty and the rate NaN. The
+    # fallback path with the per-row check only runs when some sweep is
+    # actually missing its interval
     try:
-        step = pd.Interval(*sweep["stimulus.interval"])
-        spikes = [e for e in sweep.events if e in step]
-        n_spikes = len(spikes)
-        rate = n_spikes / step.length
-        if len(spikes) == 0:
-            duration = np.nan
-        elif len(spikes) == 1:
-            duration = (
-                sweep["first_spike.width"] + sweep["first_spike.trough_t"]
-            ) / 1000.0
-        else:
-            duration = spikes[-1] - spikes[0]
-    except TypeError:
-        rate = duration = np.nan
-        n_spikes = 0
-    # spontaneous spikes
-    spont_interval = pd.Interval(*sweep["spont_interval"])
-    spont_spikes = [e for e in sweep.events if e in spont_interval]
-    return pd.Series(
+        bounds = np.asarray(sweeps["stimulus.interval"].to_list(), dtype="d")
+    except (ValueError, TypeError):
+        bounds = None
+    if bounds is None or bounds.ndim != 2:
+        # some (or all) sweeps are missing their interval
+        bounds = np.asarray(
+            [
+                iv if isinstance(iv, (list, tuple)) else (np.nan, np.nan)
+                for iv in sweeps["stimulus.interval"]
+            ],
+            dtype="d",
+        )
+    starts = bounds[:, 0]
+    stops = bounds[:, 1]
+    spont = np.asarray(sweeps["spont_interval"].to_list(), dtype="d")
+    # CSR layout: the (sorted) spike times of all sweeps in one array plus
+    # per-sweep offsets, so each window query is two binary searches rather
+    # than a mask over the whole event list
+    event_arrays = [np.asarray(ev, dtype="d") for ev in sweeps["events"]]
+    offsets = np.zeros(n + 1, dtype=np.intp)
+    np.cumsum([ev.size for ev in event_arrays], out=offsets[1:])
+    events_concat = (
+        np.concatenate(event_arrays) if event_arrays else np.empty(0, dtype="d")
+    )
+    counts = np.zeros(n, dtype=np.intp)
+    firsts = np.empty(n)
+    lasts = np.empty(n)
+    n_spont = np.zeros(n, dtype=np.intp)
+    for i in range(n):
+        events = events_concat[offsets[i] : offsets[i + 1]]
+        lo = np.searchsorted(events, starts[i], side="right")
+        hi = np.searchsorted(events, stops[i], side="right")
+        count = counts[i] = hi - lo
+        if count > 0:
+            firsts[i] = events[lo]
+            lasts[i] = events[hi - 1]
+        n_spont[i] = np.searchsorted(
+            events, spont[i, 1], side="right"
+        ) - np.searchsorted(events, spont[i, 0], side="right")
+    rate = counts / (stops - starts)
+    widths = sweeps["first_spike.width"].to_numpy(dtype="d")
+    troughs = sweeps["first_spike.trough_t"].to_numpy(dtype="d")
+    duration = np.where(
+        counts > 1,
+        lasts - firsts,
+        np.where(counts == 1, (widths + troughs) / 1000.0, np.nan),
+    )
+    return pd.DataFrame(
         {
-            "current": sweep["stimulus.I"],
+            "current": sweeps["stimulus.I"].to_numpy(),
             "firing_rate": rate,
             "firing_duration": duration,
-            "Rs": sweep.Rs,
-            "Rm": sweep.Rm,
-            "Vm": sweep.Vm,
-            "temperature": sweep.temperature,
-            "spike_width": sweep["first_spike.width"],
-            "spike_trough": sweep["first_spike.trough_t"],
-            "n_evoked": n_spikes,
-            "n_spont": len(spont_spikes),
-        }
+            "Rs": sweeps["Rs"].to_numpy(),
+            "Rm": sweeps["Rm"].to_numpy(),
+            "Vm": sweeps["Vm"].to_numpy(),
+            "temperature": sweeps["temperature"].to_numpy(),
+            "spike_width": widths,
+            "spike_trough": troughs,
+            "n_evoked": counts,
+            "n_spont": n_spont,
+        },
+        index=sweeps.index,
     )
 
 
-def epoch_firing_slope(sweeps):
-    """Computes Δf/ΔI for all sweeps above rheobase"""
-    (idx,) = (sweeps.firing_rate > 0).to_numpy().nonzero()
-    # if there are no spikes, slope is undefined for all sweeps
-    if len(idx) == 0:
-        return pd.Series(np.nan, index=sweeps.index)
-    # otherwise, slope is only undefined below the rheobase
-    slope = sweeps.firing_rate.diff() / sweeps.current.diff()
-    slope.iloc[: idx[0]] = np.nan
-    return slope
+def epoch_firing_slope(sweep_stats):
+    """Computes Δf/ΔI for all sweeps above rheobase (one epoch per call)"""
+    # sweep_stats covers a single epoch here, so the slopes come from one
+    # plain diff with no groupby machinery. slope is only defined from the
+    # first spiking sweep (rheobase) onward; epochs with no spikes at all
+    # come out as all-NaN
+    rate = sweep_stats.firing_rate.to_numpy()
+    current = sweep_stats.current.to_numpy()
+    slope = np.full(rate.size, np.nan)
+    if rate.size > 1:
+        slope[1:] = np.diff(rate) / np.diff(current)
+    has_fired = np.maximum.accumulate(rate > 0)
+    return pd.Series(
+        np.where(has_fired, slope, np.nan),
+        index=sweep_stats.index,
+        name="firing_rate_slope",
+    )
 
 
-def epoch_firing_stats(sweeps):
-    """Compute firing stats by epoch"""
-    # epoch_firing_slope already determines the rheobase, so we just need to
-    # find the first valid index
-    try:
-        fr_slope = sweeps.firing_rate_slope
-        slope = fr_slope.mean()
-        idx = fr_slope.index.get_loc(fr_slope.first_valid_index())
-        # this will be nan if idx is 0, which corresponds to spikes when zero
-        # current was injected
-        I_0 = sweeps.current.iloc[idx - 1 : idx + 1].mean()
-    except KeyError:
-        # if there are no spikes, rheobase is undefined and slope is zero
-        I_0 = np.nan
-        slope = 0
-    return pd.Series(
+def process_epoch(path, max_Vm_deviance):
+    """Reduce one pprox file to its sweep-level statistics tables.
+
+    Each file holds a single (cell, epoch), so everything through the f-I
+    slope is local to the file and can run in a worker process. Returns the
+    sweep statistics, the long-form I-V table, a one-row metadata record,
+    and the number of sweeps excluded for Vm deviance; the raw sweep table
+    (event lists and step matrices) never leaves the worker.
+    """
+    sweeps = load_epoch(path)
+    # a file where no sweep spikes, or none has a depolarizing step, lacks
+    # these fields entirely (the old whole-dataset concat supplied them as
+    # NaN from other files); fill them in so the statistics below see NaN
+    # instead of raising KeyError
+    for col in (
+        "stimulus.interval",
+        "first_spike.width",
+        "first_spike.trough_t",
+        "Rm",
+        "Vm",
+    ):
+        if col not in sweeps.columns:
+            sweeps[col] = np.nan
+    iv_wide = sweep_iv_stats(sweeps)
+    # the step lists now live in iv_wide as dense float matrices (SoA), so
+    # drop the object columns; the row filter below then copies numeric
+    # blocks instead of chasing per-row Python lists
+    sweeps = sweeps.drop(columns=["steps.I", "steps.V"])
+    # absolute deviation from the epoch median (in MADs); with one epoch per
+    # file the grouped median transforms reduce to plain column medians.
+    # only the baseline and hyperpolarization steps feed the mask
+    voltage = iv_wide["voltage"][[0, 2, 3, 4]].to_numpy()
+    dev = np.abs(voltage - np.nanmedian(voltage, axis=0))
+    v_dev = dev / np.nanmedian(dev, axis=0)
+    bad_sweeps = (v_dev > max_Vm_deviance).any(axis=1)
+    good = ~bad_sweeps
+    # build the long (sweep, step) form straight from the good rows of the
+    # dense matrix - one boolean gather plus reshapes - instead of filtering
+    # the wide frame and then stack()ing it
+    vals = iv_wide.to_numpy()[good]
+    nsteps = vals.shape[1] // 2
+    base = iv_wide.index[good]
+    long_index = pd.MultiIndex.from_arrays(
+        [base.get_level_values(i).repeat(nsteps) for i in range(base.nlevels)]
+        + [np.tile(np.arange(nsteps), len(base))],
+        names=[*base.names, "step"],
+    )
+    current = vals[:, :nsteps].reshape(-1)
+    volts = vals[:, nsteps:].reshape(-1)
+    iv_stats = pd.DataFrame(
+        {"current": current, "voltage": volts}, index=long_index
+    ).rename_axis(columns="value")
+    # stack("step") dropped steps with neither value defined; do the same
+    iv_stats = iv_stats.loc[~(np.isnan(current) & np.isnan(volts))]
+    # the metadata columns are constant within the file
+    row = sweeps.iloc[0]
+    cell, epoch, _sweep = sweeps.index[0]
+    meta = {
+        "cell": cell,
+        "epoch": epoch,
+        "bird": row["bird"],
+        "age": row["age"],
+        "sex": row["sex"],
+        "sire": row["sire"],
+        "dam": row["dam"],
+        "timestamp": row["timestamp"],
+        "tau": row["tau"],
+        "Cm": row["Cm"],
+    }
+    sweeps = sweeps.loc[good]
+    sweep_stats = sweep_firing_stats(sweeps)
+    sweep_stats = sweep_stats.join(epoch_firing_slope(sweep_stats))
+    return sweep_stats, iv_stats, meta, int(bad_sweeps.sum())
+
+
+def epoch_firing_stats(sweep_stats):
+    """Compute firing stats by epoch (all epochs at once, native reductions)"""
+    keys = ["cell", "epoch"]
+    # observed=True: the index levels are categorical, and without it the
+    # reductions would emit a row for every (cell, epoch) combination,
+    # including epochs a cell never had
+    g = sweep_stats.groupby(level=keys, observed=True)
+    # rheobase: midpoint between the first sweep with a valid f-I slope and
+    # the sweep before it; NaN for epochs that never fire. The first valid
+    # row in each group is where the running count of valid rows hits one,
+    # and since first_valid marks at most one row per epoch, the grouped sum
+    # just selects it
+    valid = sweep_stats.firing_rate_slope.notna()
+    first_valid = valid & valid.groupby(level=keys, observed=True).cumsum().eq(1)
+    midpoint = (
+        sweep_stats.current
+        + sweep_stats.current.groupby(level=keys, observed=True).shift(1)
+    ) / 2.0
+    rheobase = (
+        midpoint.where(first_valid)
+        .groupby(level=keys, observed=True)
+        .sum(min_count=1)
+    )
+    return pd.DataFrame(
         {
-            "n_sweeps": sweeps.shape[0],
-            "duration_max": sweeps.firing_duration.max(),
-            "duration_mean": sweeps.firing_duration.mean(),
-            "duration_sd": sweeps.firing_duration.std(),
-            "rate_max": sweeps.firing_rate.max(),
-            "rheobase": I_0,
-            "slope": slope,
-            "Rs": sweeps.Rs.mean(),
-            "Rs_sd": sweeps.Rs.std(),
-            "Rm": sweeps.Rm.mean(),
-            "Rm_sd": sweeps.Rm.std(),
-            "Vm": sweeps.Vm.mean(),
-            "Vm_sd": sweeps.Vm.std(),
-            "temperature": sweeps.temperature.mean(),
-            "spike_width": sweeps.spike_width.mean(),
-            "spike_trough": sweeps.spike_trough.mean(),
-            "n_evoked": sweeps.n_evoked.sum(),
-            "n_spont": sweeps.n_spont.sum(),
+            "n_sweeps": g.size(),
+            "duration_max": g["firing_duration"].max(),
+            "duration_mean": g["firing_duration"].mean(),
+            "duration_sd": g["firing_duration"].std(),
+            "rate_max": g["firing_rate"].max(),
+            "rheobase": rheobase,
+            # if there are no spikes, rheobase is undefined and slope is zero
+            "slope": g["firing_rate_slope"].mean().fillna(0),
+            "Rs": g["Rs"].mean(),
+            "Rs_sd": g["Rs"].std(),
+            "Rm": g["Rm"].mean(),
+            "Rm_sd": g["Rm"].std(),
+            "Vm": g["Vm"].mean(),
+            "Vm_sd": g["Vm"].std(),
+            "temperature": g["temperature"].mean(),
+            "spike_width": g["spike_width"].mean(),
+            "spike_trough": g["spike_trough"].mean(),
+            "n_evoked": g["n_evoked"].sum(),
+            "n_spont": g["n_spont"].sum(),
         }
     )
 
 
 def write_results(df, path, name):
-    df.to_csv(path)
+    # pyarrow's writer formats in parallel, unlike to_csv's per-cell Python
+    # formatting; the index becomes leading columns as with to_csv
+    try:
+        import pyarrow as pa
+        from pyarrow import csv
+    except ImportError:
+        df.to_csv(path)
+    else:
+        csv.write_csv(pa.Table.from_pandas(df.reset_index()), path)
     log.info("  - wrote %s to '%s'", name, path)
 
 
@@ -226,17 +359,42 @@ if __name__ == "__main__":
     log.info("- date: %s", datetime.datetime.now())
     log.info("- version: %s", __version__)
 
-    log.info("- loading %d pprox files", len(args.epochs))
-    sweeps = pd.concat([load_epoch(path) for path in args.epochs])
+    log.info("- processing %d pprox files", len(args.epochs))
+    # each file is one (cell, epoch), so the whole sweep-level pipeline runs
+    # per file in worker processes and only the small result tables come
+    # back; handing out the largest files first keeps one big pprox from
+    # becoming a tail straggler
+    paths = sorted(args.epochs, key=lambda p: p.stat().st_size, reverse=True)
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+        results = list(
+            pool.map(
+                process_epoch, paths, repeat(args.max_Vm_deviance), chunksize=1
+            )
+        )
+    sweep_stats = pd.concat([r[0] for r in results])
+    iv_stats = pd.concat([r[1] for r in results])
+    # order the epoch records by cell and epoch so the per-cell deltas below
+    # are relative to each cell's first epoch regardless of dispatch order
+    meta = pd.DataFrame.from_records([r[2] for r in results]).sort_values(
+        ["cell", "epoch"]
+    )
+    log.info("  - excluded %d sweeps (Vm deviance)", sum(r[3] for r in results))
+    # hash the cell and epoch index levels once so that the grouped epoch
+    # statistics work on integer category codes instead of re-hashing strings
+    sweep_stats.index = sweep_stats.index.set_levels(
+        [
+            sweep_stats.index.levels[0].astype("category"),
+            sweep_stats.index.levels[1].astype("category"),
+            sweep_stats.index.levels[2],
+        ]
+    )
     cells = (
-        sweeps.reset_index()[["cell", "bird", "age", "sex", "sire", "dam"]]
-        .drop_duplicates()
+        meta[["cell", "bird", "age", "sex", "sire", "dam"]]
+        .drop_duplicates("cell")
         .set_index("cell")
     )
-    epochs = (
-        sweeps.reset_index()[["cell", "epoch", "timestamp", "tau", "Cm"]]
-        .drop_duplicates()
-        .set_index(["cell", "epoch"])
+    epochs = meta[["cell", "epoch", "timestamp", "tau", "Cm"]].set_index(
+        ["cell", "epoch"]
     )
     ts = epochs.pop("timestamp").apply(pd.Timestamp)
     epochs["time"] = (
@@ -244,36 +402,11 @@ if __name__ == "__main__":
         .apply(lambda x: (x - x.iloc[0]))
         .apply(lambda x: x.total_seconds())
     )
-    log.info("- computing I-V functions")
-    iv_stats = sweeps.parallel_apply(sweep_iv_stats, axis=1)
-    log.info("- checking for bad sweeps (Vm deviance)")
-    v_dev = (
-        iv_stats["voltage"]
-        .groupby(["cell", "epoch"], group_keys=False)
-        .parallel_apply(iv_deviation)
-    )
-    # only look at baseline and hyperpolarization steps
-    bad_sweeps = (v_dev[[0, 2, 3, 4]] > args.max_Vm_deviance).any(axis=1)
-    log.info("  - excluded %d sweeps", bad_sweeps.sum())
-
-    sweeps = sweeps.loc[~bad_sweeps]
-    iv_stats = iv_stats.loc[~bad_sweeps].stack("step")
-
-    log.info("- computing sweep-level statistics")
-    sweep_stats = sweeps.parallel_apply(sweep_firing_stats, axis=1)
-    sweep_slope_stats = (
-        sweep_stats.groupby(["cell", "epoch"], group_keys=False)
-        .apply(epoch_firing_slope)
-        .rename("firing_rate_slope")
-    )
-    sweep_stats = sweep_stats.join(sweep_slope_stats)
     write_results(iv_stats, args.output_dir / "iv_stats.csv", "I-V steps")
     write_results(sweep_stats, args.output_dir / "sweep_stats.csv", "sweep statistics")
 
     log.info("- computing epoch-level statistics")
-    epoch_stats = (
-        sweep_stats.groupby(["cell", "epoch"]).apply(epoch_firing_stats).join(epochs)
-    )
+    epoch_stats = epoch_firing_stats(sweep_stats).join(epochs)
     r_dev = (
         epoch_stats[["Rs", "Rm"]]
         .groupby("cell", group_keys=False)
@@ -287,11 +420,12 @@ if __name__ == "__main__":
         .rename(columns=lambda s: f"delta_{s}")
     )
     # NB: cumulative sum is the number of spikes before each epoch
+    # (cumsum minus the epoch's own count, i.e. shift(1).cumsum() per cell)
+    total_spikes = epoch_stats["n_spont"] + epoch_stats["n_evoked"]
     cum_spikes = (
-        epoch_stats.groupby("cell", group_keys=False)
-        .apply(
-            lambda df: (df["n_spont"] + df["n_evoked"]).shift(1, fill_value=0).cumsum()
-        )
+        total_spikes.groupby(level="cell")
+        .cumsum()
+        .sub(total_spikes)
         .rename("cum_spikes")
     )
 
@@ -4,9 +4,12 @@
 """ Scan all the epochs for a cell and output if they are gapfree or epochal """
 import datetime
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
 
 import nbank as nb
+import quantities as pq
 from neo import AxonIO
 
 from core import _units, setup_log
@@ -14,6 +17,27 @@ from core import _units, setup_log
 log = logging.getLogger()
 __version__ = "20221017"
 
+
+def scan_epoch(neuron, epoch_idx, abf, command_channel):
+    """Returns True if abf is an epochal current-clamp recording"""
+    log.debug("- reading %s", abf)
+    ifp = AxonIO(abf)
+    # read_raw_protocol skips wrapping every sweep's protocol in neo
+    # segments; classifying the file only needs the first episode's command
+    # channel and its units
+    episodes, _sig_names, sig_units = ifp.read_raw_protocol()
+    try:
+        _ = episodes[0][command_channel]
+        pq.Quantity(1.0, sig_units[command_channel]).rescale(_units["current"])
+    except IndexError:
+        log.debug("%s %d: gapfree", neuron, epoch_idx)
+    except ValueError:
+        log.debug("%s %d: not current clamp", neuron, epoch_idx)
+    else:
+        return True
+    return False
+
+
 if __name__ == "__main__":
     import argparse
 
@@ -39,22 +63,17 @@ if __name__ == "__main__":
     if path is None:
         log.error("  - error: `%s` is not in neurobank registry", args.neuron)
         parser.exit(-1)
-    for epoch_idx, abf in enumerate(sorted(Path(path).glob("*.abf")), 1):
-        log.debug("- reading %s", abf)
-        ifp = AxonIO(abf)
-        protocols = ifp.read_protocol()
-        sweep_idx = 0
-        try:
-            Ic = (
-                protocols[sweep_idx]
-                .analogsignals[args.command_channel]
-                .rescale(_units["current"])
-                .squeeze()
-                .magnitude
-            )
-        except IndexError:
-            log.debug("%s %d: gapfree", args.neuron, epoch_idx)
-        except ValueError:
-            log.debug("%s %d: not current clamp", args.neuron, epoch_idx)
-        else:
-            print(f"{args.neuron} {epoch_idx}")
+    epoch_files = sorted(Path(path).glob("*.abf"))
+    # each file is scanned independently, so spread them over processes and
+    # emit the results in epoch order
+    with ProcessPoolExecutor() as pool:
+        results = pool.map(
+            scan_epoch,
+            repeat(args.neuron),
+            range(1, len(epoch_files) + 1),
+            epoch_files,
+            repeat(args.command_channel),
+        )
+        for epoch_idx, is_epochal in enumerate(results, 1):
+            if is_epochal:
+                print(f"{args.neuron} {epoch_idx}")